@@ -1,2 +1,10 @@
 from . import definitions
 from .niceday_client import NicedayClient, TrackerStatus
+
+
+def __getattr__(name):
+    # AsyncNicedayClient pulls in aiohttp, only import it when it is asked for
+    if name == 'AsyncNicedayClient':
+        from .async_client import AsyncNicedayClient
+        return AsyncNicedayClient
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
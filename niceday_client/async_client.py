@@ -0,0 +1,230 @@
+import asyncio
+import datetime
+import typing
+
+import aiohttp
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
+
+from .niceday_client import (_REMINDER_MARGIN, _REMINDER_MARGIN_LIST, TrackerStatus,
+                             _check_results, _extract_profile, orjson)
+
+if typing.TYPE_CHECKING:
+    from dateutil.rrule import rrule
+
+
+def _is_transient_error(e: BaseException) -> bool:
+    """
+    Whether a failed request is worth retrying: connection problems and 5xx
+    responses are, 4xx responses (e.g. authentication failures) are not.
+    """
+    if isinstance(e, aiohttp.ClientResponseError):
+        return e.status >= 500
+    return isinstance(e, aiohttp.ClientConnectionError)
+
+
+class AsyncNicedayClient:
+    """
+    Asynchronous client for interacting with the niceday-api component of the
+    PerfectFit stack. Calls can be awaited concurrently (e.g. with
+    asyncio.gather), the number of requests in flight is capped by the
+    concurrency parameter.
+
+    Example Usage:
+        ```
+        async with AsyncNicedayClient() as client:
+            profiles = await asyncio.gather(*[client.get_profile(uid) for uid in user_ids])
+    """
+
+    def __init__(self, niceday_api_uri='http://localhost:8080/',
+                 session: typing.Optional[aiohttp.ClientSession] = None,
+                 concurrency: int = 16):
+        """
+        Construct an async client for interacting with the given niceday API URI.
+        By default, this is assumed to be on http://localhost:8080/, but
+        can be set with the niceday_api_uri parameter.
+
+        Args:
+            niceday_api_uri: URI of the niceday-api
+            session: aiohttp session to reuse for all requests. If not given, one
+                is created when the client is first used and closed by close().
+            concurrency: Maximum number of requests in flight at the same time
+        """
+
+        self._niceday_api_uri = niceday_api_uri
+
+        # Endpoint URLs are built once here instead of on every call
+        self._userdata_url = niceday_api_uri + 'userdata/'
+        self._messages_url = niceday_api_uri + 'messages/'
+        self._tracker_statuses_url = niceday_api_uri + 'usertrackers/statuses'
+        self._smoking_url = niceday_api_uri + 'usertrackers/smoking/'
+        self._reminder_url = niceday_api_uri + 'usertrackers/reminder'
+
+        self._session = session
+        self._owns_session = session is None
+        # The semaphore is created on first use, so it belongs to the running
+        # event loop rather than to whichever loop exists at construction
+        self._concurrency = concurrency
+        self._semaphore: typing.Optional[asyncio.Semaphore] = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def close(self):
+        """
+        Close the underlying aiohttp session, if it was created by this client.
+        """
+        if self._owns_session and self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._concurrency)
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+        return self._session
+
+    @retry(wait=wait_exponential(multiplier=0.3, max=5), stop=stop_after_attempt(5),
+           retry=retry_if_exception(_is_transient_error), reraise=True)
+    async def _call_api(self,
+                        method: str,
+                        url: str,
+                        query_params: typing.Optional[dict] = None,
+                        body: typing.Optional[dict] = None) -> typing.Any:
+        """
+        Handles http requests with the niceday-api.
+
+        Args:
+            method: (str) Which HTTP method to use
+            url: (str) Specifies the desired url e.g. 'profiles' or 'messages'
+            query_params: (dict) Parameters that should go in the query string of the request URL
+            body: (dict) Body to send with request
+
+        Returns:
+            The decoded JSON body of the response, or None if the body is empty.
+            Write (POST) responses that are not JSON are returned as text.
+        """
+
+        if method not in ('GET', 'POST'):
+            raise NotImplementedError('Other methods are not implemented yet')
+
+        headers = {"Accept": "application/json"}
+        if query_params is None:
+            query_params = {}
+
+        if body is not None and orjson is not None:
+            headers["Content-Type"] = "application/json"
+            kwargs = {'data': orjson.dumps(body)}
+        else:
+            kwargs = {'json': body}
+
+        session = self._get_session()
+        async with self._semaphore:
+            response = await session.request(
+                method, url, params=query_params, headers=headers, **kwargs)
+            async with response:
+                response.raise_for_status()
+                try:
+                    return await response.json(content_type=None)
+                except ValueError as e:
+                    if method == 'POST':
+                        # the write succeeded, the niceday-api just did not answer in JSON
+                        return await response.text()
+                    raise ValueError('The niceday-api did not return JSON.') from e
+
+    async def _get_raw_user_data(self, user_id) -> dict:
+        """
+        Returns the niceday user data corresponding to the given user id.
+        See NicedayClient._get_raw_user_data.
+        """
+        url = self._userdata_url + str(user_id)
+        results = await self._call_api('GET', url)
+        _check_results(results)
+        return results
+
+    async def get_profile(self, user_id) -> dict:
+        """
+        Returns the niceday user profile corresponding to the given user id.
+        See NicedayClient.get_profile.
+        """
+        user_data = await self._get_raw_user_data(user_id)
+        return _extract_profile(user_data)
+
+    async def get_profiles_batch(self, user_ids: typing.List[int]) -> typing.Dict[int, dict]:
+        """
+        Returns the niceday user profiles for all given user ids, fetched
+        concurrently (bounded by the concurrency of this client).
+
+        Returns:
+            Dict mapping each user id to its profile (see get_profile).
+        """
+        profiles = await asyncio.gather(*[self.get_profile(uid) for uid in user_ids])
+        return dict(zip(user_ids, profiles))
+
+    async def post_message(self, recipient_id: int, text: str):
+        """
+        Post a message to the niceday server.
+
+        Args:
+            recipient_id: user id of the recipient
+            text: text message to send
+
+        """
+        url = self._messages_url
+        body = {
+            "recipient_id": recipient_id,
+            "text": text
+        }
+        return await self._call_api('POST', url, body=body)
+
+    async def set_user_tracker_statuses(self, user_id: int, tracker_statuses: typing.List[TrackerStatus]):
+        """
+        Set tracker statuses for a specific user.
+        See NicedayClient.set_user_tracker_statuses.
+        """
+        url = self._tracker_statuses_url
+        body = {
+            "userId": user_id,
+            "trackerStatuses": [{"trackerId": int(ts.trackerId), "isEnabled": bool(ts.isEnabled)}
+                                for ts in tracker_statuses]
+        }
+        return await self._call_api('POST', url, body=body)
+
+    async def get_smoking_tracker(self, user_id: int, start_time: datetime.datetime,
+                                  end_time: datetime.datetime):
+        """
+        Get smoking tracker data for specific user.
+        See NicedayClient.get_smoking_tracker.
+        """
+        url = self._smoking_url + str(user_id)
+        query_params = {'startTime': start_time.isoformat() + 'Z',
+                        'endTime': end_time.isoformat() + 'Z'}
+        results = await self._call_api('GET', url, query_params=query_params)
+        _check_results(results)
+        return results
+
+    async def set_tracker_reminder(self, user_id: int, tracker_name: str, reminder_title: str, recurrence_rule: 'rrule'):
+        """
+        Set tracker reminder for a specific user.
+        See NicedayClient.set_tracker_reminder.
+        """
+        url = self._reminder_url
+
+        recurring_schedule = {
+            "title": reminder_title,
+            "schedule_type": tracker_name,
+            "recurring_expression": {
+                "margin": _REMINDER_MARGIN,
+                "reminder_enabled": True,
+                "reminder_margin": _REMINDER_MARGIN_LIST,
+                "rrule": str(recurrence_rule)
+            }
+        }
+        body = {
+            "userId": str(user_id),
+            "recurringSchedule": recurring_schedule
+        }
+        return await self._call_api('POST', url, body=body)
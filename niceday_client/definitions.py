@@ -1,7 +1,11 @@
-from enum import Enum
+from enum import Enum, IntEnum
 
-USER_PROFILE_KEYS = ['firstName', 'lastName', 'location', 'birthDate', 'gender']
+USER_PROFILE_KEYS = ('firstName', 'lastName', 'location', 'birthDate', 'gender')
 
 
-class Tracker(Enum):
-    SMOKING = (1, 'tracker_smoking')
+class Tracker(IntEnum):
+    SMOKING = 1
+
+
+class TrackerName(str, Enum):
+    SMOKING = 'tracker_smoking'
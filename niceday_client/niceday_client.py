@@ -1,14 +1,36 @@
 import typing
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 import datetime
-from dateutil.rrule import rrule
-import json
-import requests
+import itertools
+import re
+import threading
+import time
 
-from .definitions import USER_PROFILE_KEYS
+try:
+    import orjson
+except ImportError:  # orjson is optional, fall back to the json encoding of requests
+    orjson = None
 
+if typing.TYPE_CHECKING:
+    from dateutil.rrule import rrule
+    import requests
 
-@dataclass
+from .definitions import USER_PROFILE_KEYS, Tracker
+
+# Error messages the niceday-api reports in the 'message' field of its responses
+_ERROR_RE = re.compile(r'(Unauthorized error|The requested resource could not be found)')
+
+# Sentinel for keys missing from the user profile (None is a valid value)
+_MISSING = object()
+
+# Invariant parts of the tracker reminder body, shared between calls (they are only read)
+_REMINDER_MARGIN = {"before": 0, "after": 60}
+_REMINDER_MARGIN_LIST = [_REMINDER_MARGIN]
+
+
+@dataclass(frozen=True)
 class TrackerStatus:
     """
     Status of a user tracker.
@@ -18,12 +40,61 @@ class TrackerStatus:
             https://github.com/senseobservationsystems/goalie-js/issues/840
             on how to get tracker IDs, for example: cigarette counter has id=1).
             Use the Tracker enum defined in definitions.py instead of hardcoding
-            integer values. e.g. 'Tracker.SMOKING.value[0]' may be used instead of 1.
+            integer values. e.g. 'Tracker.SMOKING' may be used instead of 1.
         isEnabled: Whether the tracker should be enabled
     """
-    trackerId: int
+    __slots__ = ('trackerId', 'isEnabled')
+
+    trackerId: typing.Union[int, Tracker]
     isEnabled: bool
 
+    # Frozen dataclasses with hand-written __slots__ cannot be copied or
+    # unpickled by the default slot state handling, so restore the fields here
+    def __getstate__(self):
+        return (self.trackerId, self.isEnabled)
+
+    def __setstate__(self, state):
+        object.__setattr__(self, 'trackerId', state[0])
+        object.__setattr__(self, 'isEnabled', state[1])
+
+
+def _check_results(results):
+    """
+    Raise a RuntimeError if the decoded niceday-api response signals an error.
+    """
+    if not isinstance(results, dict):
+        return
+    m = _ERROR_RE.search(results.get('message', ''))
+    if m is not None:
+        msg = f"'{m.group(1)}' response from niceday server. "
+        if 'details' in results and 'body' in results['details']:
+            msg += 'Details provided: ' + str(results['details']['body'])
+        raise RuntimeError(msg)
+
+
+def _extract_profile(user_data: dict) -> dict:
+    """
+    Pick the USER_PROFILE_KEYS out of the raw niceday user data.
+    """
+    if 'userProfile' not in user_data:
+        raise ValueError('NicedayClient expected user data from '
+                         'niceday-api to contain the key "userProfile" '
+                         'but this is missing. Has the data structure '
+                         'stored on the Senseserver changed?')
+
+    profile = user_data['userProfile']
+    return_profile = {}
+    for k in USER_PROFILE_KEYS:
+        v = profile.get(k, _MISSING)
+        if v is _MISSING:
+            raise ValueError(f'"userProfile" dict returned from '
+                             f'niceday-api does not contain expected '
+                             f'key "{k}". Has the data structure '
+                             f'stored on the Senseserver changed?')
+        return_profile[k] = v
+
+    return return_profile
+
 
 class NicedayClient:
     """
@@ -31,21 +102,74 @@ class NicedayClient:
     stack.
     """
 
-    def __init__(self, niceday_api_uri='http://localhost:8080/'):
+    def __init__(self, niceday_api_uri='http://localhost:8080/', profile_ttl_seconds: float = 300,
+                 profile_cache_size: int = 1024):
         """
         Construct a client for interacting with the given niceday API URI.
         By default, this is assumed to be on http://localhost:8080/, but
         can be set with the niceday_api_uri parameter.
+
+        User data fetched by get_profile is cached for profile_ttl_seconds
+        seconds, for at most profile_cache_size users. The least recently used
+        user is evicted when the cache is full. Once an entry is older than the
+        TTL it is revalidated with the server (If-None-Match), so with a TTL of
+        0 every call still goes to the server but unchanged data is not
+        downloaded again.
         """
 
         self._niceday_api_uri = niceday_api_uri
 
+        # Endpoint URLs are built once here instead of on every call
+        self._userdata_url = niceday_api_uri + 'userdata/'
+        self._messages_url = niceday_api_uri + 'messages/'
+        self._tracker_statuses_url = niceday_api_uri + 'usertrackers/statuses'
+        self._smoking_url = niceday_api_uri + 'usertrackers/smoking/'
+        self._reminder_url = niceday_api_uri + 'usertrackers/reminder'
+
+        self._profile_ttl_seconds = profile_ttl_seconds
+        self._profile_cache_size = profile_cache_size
+        # Maps user id to (time.monotonic() of fetch, ETag of the response, raw user data),
+        # ordered from least to most recently used
+        self._profile_cache: typing.Dict[int, typing.Tuple[float, typing.Optional[str], dict]] = OrderedDict()
+        self._profile_cache_lock = threading.Lock()
+
+        # requests is imported here rather than at module level, so importing
+        # this package (e.g. only for the definitions) stays cheap
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util import Retry
+
+        # Reuse one session (and its pooled keep-alive connections) for all calls
+        self._session = requests.Session()
+        self._session.headers.update({"Accept": "application/json"})
+        # Retry transient server errors with exponential backoff, 4xx responses
+        # (e.g. authentication failures) are not retried
+        retries = Retry(total=5, backoff_factor=0.3, status_forcelist=[500, 502, 503, 504],
+                        allowed_methods={"GET", "POST"}, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=32, max_retries=retries)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Close the underlying HTTP session and its pooled connections.
+        """
+        self._session.close()
+
     def _call_api(self,
                   method: str,
                   url: str,
                   query_params: typing.Optional[dict] = None,
                   body: typing.Optional[dict] = None,
-                  files: typing.List[typing.Tuple[str, typing.Tuple[str, typing.Any, str]]] = None) -> requests.Response:
+                  files: typing.List[typing.Tuple[str, typing.Tuple[str, typing.Any, str]]] = None,
+                  stream: bool = False,
+                  headers: typing.Optional[dict] = None) -> 'requests.Response':
         """
         Handles http requests with the niceday-api.
 
@@ -54,42 +178,44 @@ class NicedayClient:
             url: (str) Specifies the desired url e.g. 'profiles' or 'messages'
             query_params: (dict) Parameters that should go in the query string of the request URL
             body: (dict) Body to send with request
+            stream: (bool) Whether to defer downloading the response body (GET only)
+            headers: (dict) Extra headers to send with the request
         """
 
-        headers = {"Accept": "application/json"}
         if query_params is None:
             query_params = {}
+        headers = dict(headers) if headers else {}
 
         if method == 'GET':
-            r = requests.get(url, params=query_params, headers=headers)
+            r = self._session.get(url, params=query_params, headers=headers, stream=stream)
         elif method == 'POST':
-            if files is None:
-                r = requests.post(url, params=query_params, headers=headers, json=body)
+            if files is None and body is not None and orjson is not None:
+                headers["Content-Type"] = "application/json"
+                r = self._session.post(url, params=query_params, headers=headers, data=orjson.dumps(body))
+            elif files is None:
+                r = self._session.post(url, params=query_params, headers=headers, json=body)
             else:
-                r = requests.post(url, params=query_params, headers=headers, data=body, files=files)
+                r = self._session.post(url, params=query_params, headers=headers, data=body, files=files)
         else:
             raise NotImplementedError('Other methods are not implemented yet')
-        r.raise_for_status()
+        try:
+            r.raise_for_status()
+        except Exception:
+            # a streamed response holds its connection until it is closed
+            r.close()
+            raise
         return r
 
-    def _extract_json(self, response: requests.Response) -> dict:
+    def _extract_json(self, response: 'requests.Response') -> dict:
         try:
             results = response.json()
         except ValueError as e:
             raise ValueError('The niceday-api did not return JSON.') from e
 
-        self._error_check(results, 'Unauthorized error')
-        self._error_check(results, 'The requested resource could not be found')
+        _check_results(results)
         return results
 
-    def _error_check(self, results, err_msg):
-        if 'message' in results and err_msg in results['message']:
-            msg = f"'{err_msg}' response from niceday server. "
-            if 'details' in results and 'body' in results['details']:
-                msg += 'Details provided: ' + str(results['details']['body'])
-            raise RuntimeError(msg)
-
-    def _get_raw_user_data(self, user_id) -> dict:
+    def _get_raw_user_data(self, user_id, refresh: bool = False) -> dict:
         """
         Returns the niceday user data corresponding to the given user id.
         This is in the form of a dict, containing the user's
@@ -98,12 +224,75 @@ class NicedayClient:
             'user' info (username, email, date joined etc.)
         The exact contents of this returned data depends on what is stored
         on the SenseServer and generally could change (beyond our control).
+
+        Results are cached per user id for profile_ttl_seconds, pass
+        refresh=True to bypass the cache. Expired (or refreshed) entries are
+        revalidated with the server using their ETag, so unchanged user data
+        is not downloaded again.
         """
-        url = self._niceday_api_uri + 'userdata/' + str(user_id)
-        response = self._call_api('GET', url)
-        return self._extract_json(response)
+        cached = self._get_cached_user_data(user_id)
+        if cached is not None and not refresh and time.monotonic() - cached[0] < self._profile_ttl_seconds:
+            return cached[2]
 
-    def get_profile(self, user_id) -> dict:
+        headers = None
+        if cached is not None and cached[1]:
+            headers = {'If-None-Match': cached[1]}
+
+        url = self._userdata_url + str(user_id)
+        response = self._call_api('GET', url, headers=headers)
+        if cached is not None and response.status_code == 304:
+            self._cache_user_data(user_id, cached[1], cached[2])
+            return cached[2]
+
+        user_data = self._extract_json(response)
+        self._cache_user_data(user_id, response.headers.get('ETag'), user_data)
+        return user_data
+
+    def _get_cached_user_data(self, user_id) -> typing.Optional[typing.Tuple[float, typing.Optional[str], dict]]:
+        """
+        Look up the profile cache entry of a user and mark it as most recently used.
+        """
+        with self._profile_cache_lock:
+            cached = self._profile_cache.get(user_id)
+            if cached is not None:
+                self._profile_cache.move_to_end(user_id)
+            return cached
+
+    def _cache_user_data(self, user_id, etag: typing.Optional[str], user_data: dict):
+        """
+        Store user data in the profile cache, evicting the least recently used
+        entries if it grows beyond profile_cache_size.
+        """
+        with self._profile_cache_lock:
+            self._profile_cache[user_id] = (time.monotonic(), etag, user_data)
+            self._profile_cache.move_to_end(user_id)
+            while len(self._profile_cache) > self._profile_cache_size:
+                self._profile_cache.popitem(last=False)
+
+    def _invalidate_user_data(self, user_id):
+        """
+        Drop the profile cache entry of a user, e.g. because its data changed.
+        """
+        with self._profile_cache_lock:
+            self._profile_cache.pop(user_id, None)
+
+    def _cache_written_user_data(self, user_id, response: 'requests.Response'):
+        """
+        Store the user data returned by a write to the niceday-api in the
+        profile cache, if the response contains any. This saves fetching it
+        again on the next get_profile call. Otherwise the entry is dropped, in
+        case a concurrent get_profile cached pre-write data during the write.
+        """
+        try:
+            results = response.json()
+        except ValueError:
+            results = None
+        if isinstance(results, dict) and 'userProfile' in results:
+            self._cache_user_data(user_id, None, results)
+        else:
+            self._invalidate_user_data(user_id)
+
+    def get_profile(self, user_id, refresh: bool = False) -> dict:
         """
         Returns the niceday user profile corresponding to the given user id.
         This is in the form of dict, containing the following keys:
@@ -112,25 +301,26 @@ class NicedayClient:
             'user' info (username, email, date joined etc.)
         The exact contents of this returned data depends on what is stored
         on the SenseServer.
+
+        The profile is served from a local cache if it was fetched less than
+        profile_ttl_seconds ago, unless refresh is True.
         """
 
-        user_data = self._get_raw_user_data(user_id)
-        if 'userProfile' not in user_data:
-            raise ValueError('NicedayClient expected user data from '
-                             'niceday-api to contain the key "userProfile" '
-                             'but this is missing. Has the data structure '
-                             'stored on the Senseserver changed?')
+        user_data = self._get_raw_user_data(user_id, refresh=refresh)
+        return _extract_profile(user_data)
 
-        return_profile = {}
-        for k in USER_PROFILE_KEYS:
-            if k not in user_data['userProfile']:
-                raise ValueError(f'"userProfile" dict returned from '
-                                 f'niceday-api does not contain expected '
-                                 f'key "{k}". Has the data structure '
-                                 f'stored on the Senseserver changed?')
-            return_profile[k] = user_data['userProfile'][k]
+    def get_profiles_batch(self, user_ids: typing.List[int], max_workers: int = 16) -> typing.Dict[int, dict]:
+        """
+        Returns the niceday user profiles for all given user ids, fetching
+        them concurrently with up to max_workers threads that share this
+        client's session.
 
-        return return_profile
+        Returns:
+            Dict mapping each user id to its profile (see get_profile).
+        """
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            profiles = executor.map(self.get_profile, user_ids)
+            return dict(zip(user_ids, profiles))
 
     def post_message(self, recipient_id: int, text: str):
         """
@@ -141,7 +331,7 @@ class NicedayClient:
             text: text message to send
 
         """
-        url = self._niceday_api_uri + 'messages/'
+        url = self._messages_url
         body = {
             "recipient_id": recipient_id,
             "text": text
@@ -154,18 +344,22 @@ class NicedayClient:
 
         Example Usage:
             ```
-            self.set_user_tracker_statuses(12345, [TrackerStatus(trackerId=Tracker.SMOKING.value[0], isEnabled=True)])
+            self.set_user_tracker_statuses(12345, [TrackerStatus(trackerId=Tracker.SMOKING, isEnabled=True)])
 
         Args:
             user_id: ID of the user we want to set tracker statuses for
             tracker_statuses: List of TrackerStatus objects.
         """
-        url = self._niceday_api_uri + 'usertrackers/statuses'
+        url = self._tracker_statuses_url
         body = {
             "userId": user_id,
-            "trackerStatuses": [ts.__dict__ for ts in tracker_statuses]
+            "trackerStatuses": [{"trackerId": int(ts.trackerId), "isEnabled": bool(ts.isEnabled)}
+                                for ts in tracker_statuses]
         }
-        return self._call_api('POST', url, body=body)
+        self._invalidate_user_data(user_id)
+        response = self._call_api('POST', url, body=body)
+        self._cache_written_user_data(user_id, response)
+        return response
 
     def get_smoking_tracker(self, user_id: int, start_time: datetime.datetime,
                             end_time: datetime.datetime):
@@ -184,22 +378,55 @@ class NicedayClient:
             in an entry).
 
         """
-        url = self._niceday_api_uri + 'usertrackers/smoking/' + str(user_id)
+        return list(self.iter_smoking_tracker(user_id, start_time, end_time))
+
+    def iter_smoking_tracker(self, user_id: int, start_time: datetime.datetime,
+                             end_time: datetime.datetime) -> typing.Iterator[dict]:
+        """
+        Iterate over the smoking tracker data for specific user. Entries are
+        parsed incrementally while the response streams in, so memory use does
+        not grow with the size of the time range.
+
+        Args:
+            user_id: ID of the user we want to get tracker data for
+            start_time: The start of the time range for which to get data
+            end_time: The end of the time range for which to get data
+
+        Yields:
+            Smoking tracker entries, see get_smoking_tracker.
+        """
+        import ijson
+
+        url = self._smoking_url + str(user_id)
         query_params = {'startTime': start_time.isoformat() + 'Z',
                         'endTime': end_time.isoformat() + 'Z'}
-        query_response = self._call_api('GET', url, query_params=query_params)
-        # convert the json response into a list of dict
-        response_json = json.loads(query_response.content)
-        return response_json
-
-    def set_tracker_reminder(self, user_id: int, tracker_name: str, reminder_title: str, recurrence_rule: rrule):
+        query_response = self._call_api('GET', url, query_params=query_params, stream=True)
+        with query_response:
+            # let urllib3 undo any gzip/deflate content encoding while streaming
+            query_response.raw.decode_content = True
+            try:
+                events = ijson.parse(query_response.raw, use_float=True)
+                first_event = next(events)
+                if first_event[1] != 'start_array':
+                    if first_event[1] == 'start_map':
+                        # e.g. an error message from the niceday-api
+                        builder = ijson.ObjectBuilder()
+                        for _, event, value in itertools.chain([first_event], events):
+                            builder.event(event, value)
+                        _check_results(builder.value)
+                    raise ValueError('The niceday-api did not return a list of smoking tracker entries.')
+                yield from ijson.items(itertools.chain([first_event], events), 'item')
+            except ijson.JSONError as e:
+                raise ValueError('The niceday-api did not return JSON.') from e
+
+    def set_tracker_reminder(self, user_id: int, tracker_name: str, reminder_title: str, recurrence_rule: 'rrule'):
         """
         Set tracker reminder for a specific user.
 
         Example Usage:
             ```
             client.set_tracker_reminder(12345,
-                                        Tracker.SMOKING.value[1],
+                                        TrackerName.SMOKING,
                                         "This is a tracker",
                                         rrule(DAILY,dtstart=datetime.datetime(2022, 5, 12, 0, 0),
                                         until=datetime.datetime(2022, 5, 13, 0, 0)))
@@ -209,28 +436,20 @@ class NicedayClient:
             tracker_name: Name of the tracker to set the reminder for (see
                 https://github.com/senseobservationsystems/goalie-js/issues/840
                 on how to get tracker name, for example: smoking tracker has name=tracker_smoking).
-                Use the Tracker enum defined in definitions.py instead of hardcoding
-                string values. e.g. 'Tracker.SMOKING.value[1]' may be used instead of 'tracker_smoking'.
+                Use the TrackerName enum defined in definitions.py instead of hardcoding
+                string values. e.g. 'TrackerName.SMOKING' may be used instead of 'tracker_smoking'.
             reminder_title: title of the reminder. This is displayed in the app
             recurrence_rule: rule for recursion setting. Use the rrule module to create the rule.
         """
-        url = self._niceday_api_uri + 'usertrackers/reminder'
+        url = self._reminder_url
 
         recurring_schedule = {
             "title": reminder_title,
             "schedule_type": tracker_name,
             "recurring_expression": {
-                "margin": {
-                    "before": 0,
-                    "after": 60
-                },
+                "margin": _REMINDER_MARGIN,
                 "reminder_enabled": True,
-                "reminder_margin": [
-                    {
-                        "before": 0,
-                        "after": 60
-                    }
-                ],
+                "reminder_margin": _REMINDER_MARGIN_LIST,
                 "rrule": str(recurrence_rule)
             }
         }
@@ -238,7 +457,10 @@ class NicedayClient:
             "userId": str(user_id),
             "recurringSchedule": recurring_schedule
         }
-        return self._call_api('POST', url, body=body)
+        self._invalidate_user_data(user_id)
+        response = self._call_api('POST', url, body=body)
+        self._cache_written_user_data(user_id, response)
+        return response
 
     def upload_file(self, user_id: int, filepath: str, file):
         """
@@ -265,9 +487,7 @@ class NicedayClient:
 
         query_response = self._call_api('POST', url, body=body, files=files)
         # convert the json response into a list of dict
-        response_json = json.loads(query_response.content)
-
-        return response_json
+        return self._extract_json(query_response)
 
     def get_invitation_requests(self):
         """
@@ -277,8 +497,7 @@ class NicedayClient:
         url = self._niceday_api_uri + 'connectionrequests'
         query_response = self._call_api('GET', url)
         # convert the json response into a list of dict
-        response_json = json.loads(query_response.content)
-        return response_json
+        return self._extract_json(query_response)
 
     def accept_invitation_request(self, invitation_id: str):
         """
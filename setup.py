@@ -5,6 +5,7 @@ setup(
     version='0.1',
     author='Robin Richardson, Sven van den Burg, Bouke Scheltinga, Nele Albers',
     install_requires=open("requirements.txt", "r").readlines(),
+    extras_require={'orjson': ['orjson']},
     long_description=open("README.md", "r").read(),
     long_description_content_type='text/markdown',
     packages=['niceday_client'],
@@ -0,0 +1,13 @@
+import pytest
+from niceday_client import NicedayClient
+
+
+@pytest.fixture(scope="session")
+def client():
+    """
+    NicedayClient shared by the integration tests (one per xdist worker), so
+    they reuse its pooled connections.
+    """
+    c = NicedayClient()
+    yield c
+    c.close()
@@ -0,0 +1,196 @@
+import asyncio
+import datetime
+from unittest import mock
+
+import aiohttp
+import pytest
+from niceday_client import AsyncNicedayClient
+from niceday_client.async_client import _is_transient_error
+from niceday_client.definitions import USER_PROFILE_KEYS, TrackerName
+
+from .test_niceday_client import EXPECTED_REMINDER_BODY, MOCK_PROFILE_RESPONSE, REMINDER_RULE
+
+
+class MockResponse:
+    """
+    Minimal stand-in for aiohttp.ClientResponse
+    """
+
+    def __init__(self, json_body=None, status=200, text=None):
+        self._json_body = json_body
+        self._text = text
+        self.status = status
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise aiohttp.ClientResponseError(mock.MagicMock(), (), status=self.status)
+
+    async def json(self, content_type=None):
+        if self._text is not None:
+            raise ValueError('not JSON')
+        return self._json_body
+
+    async def text(self):
+        return self._text
+
+
+class MockSession:
+    """
+    Minimal stand-in for aiohttp.ClientSession that records the requests made
+    and the maximum number of them in flight at the same time.
+    """
+
+    def __init__(self, response):
+        self._response = response
+        self.requests = []
+        self.request_kwargs = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.close = mock.AsyncMock()
+
+    async def request(self, method, url, **kwargs):
+        self.requests.append((method, url))
+        self.request_kwargs.append(kwargs)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0)
+        self.in_flight -= 1
+        return self._response
+
+
+def test_get_profile():
+    """
+    Unit test for AsyncNicedayClient.get_profile() method with mocked session
+    """
+    session = MockSession(MockResponse(MOCK_PROFILE_RESPONSE))
+    client = AsyncNicedayClient(session=session)
+    profile = asyncio.run(client.get_profile(12345))
+
+    assert session.requests == [('GET', 'http://localhost:8080/userdata/12345')]
+    assert list(profile) == list(USER_PROFILE_KEYS)
+
+
+def test_get_profiles_batch_concurrency():
+    """
+    get_profiles_batch() fetches all profiles, with no more than `concurrency`
+    requests in flight at the same time
+    """
+    session = MockSession(MockResponse(MOCK_PROFILE_RESPONSE))
+    client = AsyncNicedayClient(session=session, concurrency=2)
+    profiles = asyncio.run(client.get_profiles_batch(list(range(10))))
+
+    assert list(profiles) == list(range(10))
+    assert len(session.requests) == 10
+    assert session.max_in_flight == 2
+
+
+def test_get_smoking_tracker_error_message():
+    """
+    Error messages in the niceday-api response are raised as RuntimeError
+    """
+    session = MockSession(MockResponse({'message': 'Unauthorized error'}))
+    client = AsyncNicedayClient(session=session)
+    with pytest.raises(RuntimeError, match='Unauthorized error'):
+        asyncio.run(client.get_smoking_tracker(12345,
+                                               datetime.datetime(2022, 1, 1),
+                                               datetime.datetime(2022, 1, 2)))
+
+
+def test_post_message_not_json():
+    """
+    A write answered with a non-JSON body succeeds and returns the text
+    """
+    session = MockSession(MockResponse(text='OK'))
+    client = AsyncNicedayClient(session=session)
+    result = asyncio.run(client.post_message(12345, 'Hello world'))
+
+    assert result == 'OK'
+    assert session.requests == [('POST', 'http://localhost:8080/messages/')]
+
+
+def test_post_body_orjson():
+    orjson = pytest.importorskip('orjson')
+    session = MockSession(MockResponse())
+    client = AsyncNicedayClient(session=session)
+    with mock.patch('niceday_client.async_client.orjson', orjson):
+        asyncio.run(client.post_message(12345, 'Hello world'))
+
+    kwargs = session.request_kwargs[0]
+    assert kwargs['data'] == b'{"recipient_id":12345,"text":"Hello world"}'
+    assert kwargs['headers']['Content-Type'] == 'application/json'
+    assert 'json' not in kwargs
+
+
+def test_post_body_without_orjson():
+    session = MockSession(MockResponse())
+    client = AsyncNicedayClient(session=session)
+    with mock.patch('niceday_client.async_client.orjson', None):
+        asyncio.run(client.post_message(12345, 'Hello world'))
+
+    kwargs = session.request_kwargs[0]
+    assert kwargs['json'] == {'recipient_id': 12345, 'text': 'Hello world'}
+    assert 'data' not in kwargs
+
+
+def test_set_tracker_reminder_body():
+    session = MockSession(MockResponse())
+    client = AsyncNicedayClient(session=session)
+    with mock.patch('niceday_client.async_client.orjson', None):
+        asyncio.run(client.set_tracker_reminder(12345, TrackerName.SMOKING, "This is a tracker",
+                                                REMINDER_RULE))
+
+    assert session.request_kwargs[0]['json'] == EXPECTED_REMINDER_BODY
+
+
+def test_get_profile_not_json():
+    session = MockSession(MockResponse(text='<html>Bad gateway</html>'))
+    client = AsyncNicedayClient(session=session)
+    with pytest.raises(ValueError, match='did not return JSON'):
+        asyncio.run(client.get_profile(12345))
+
+
+def test_is_transient_error():
+    """
+    Connection errors and 5xx responses are retried, 4xx responses are not
+    """
+    assert _is_transient_error(aiohttp.ClientResponseError(mock.MagicMock(), (), status=503))
+    assert _is_transient_error(aiohttp.ClientConnectionError())
+    assert not _is_transient_error(aiohttp.ClientResponseError(mock.MagicMock(), (), status=401))
+    assert not _is_transient_error(ValueError())
+
+
+def test_client_error_not_retried():
+    session = MockSession(MockResponse(status=401))
+    client = AsyncNicedayClient(session=session)
+    with pytest.raises(aiohttp.ClientResponseError):
+        asyncio.run(client.get_profile(12345))
+    assert len(session.requests) == 1
+
+
+def test_close_caller_session():
+    """
+    A session passed in by the caller is left open by close()
+    """
+    session = MockSession(MockResponse())
+    client = AsyncNicedayClient(session=session)
+    asyncio.run(client.close())
+    session.close.assert_not_awaited()
+
+
+def test_close_own_session():
+    """
+    A session created by the client is closed by close()
+    """
+    async def use_client():
+        async with AsyncNicedayClient() as client:
+            session = client._get_session()
+        return session
+
+    session = asyncio.run(use_client())
+    assert session.closed
@@ -1,19 +1,25 @@
+import copy
+import dataclasses
 import datetime
+import io
+import pickle
 from unittest import mock
 
+from dateutil.rrule import DAILY, rrule
+
 import pytest
+import requests
 from niceday_client import NicedayClient, TrackerStatus
-from niceday_client.definitions import USER_PROFILE_KEYS, Tracker
+from niceday_client.definitions import USER_PROFILE_KEYS, Tracker, TrackerName
 
 MOCK_PROFILE_RESPONSE = {'id': 12345, 'networks': [{'networkMemberId': 123456, 'networkId': 112233, 'role': 'patient', 'createdAt': '2021-04-28T10:53:44.438Z', 'isActive': True, 'deletedAt': None, 'deletedBy': None}], 'userProfile': {'firstName': 'Test', 'lastName': 'McTesterson', 'bio': '', 'location': 'Pyteststad', 'birthDate': '1894-01-22', 'gender': 'MALE', 'image': None, 'preferredLanguage': 'en', 'settings': {'app': {'version': 1, 'settings': {'notifications': {'timesPrimed': 2, 'lastPrimingDate': '2222-03-22T11:53:50.106Z'}, 'trackerOrder': [-1, -2, -3, -4, -5, 1], 'appOnboarding': {'welcome': '2021-04-19T12:49:32.800Z', 'finished': 'current_block', 'eventPlanning': '2021-04-19T12:52:05.063Z', 'connectionPath': '2021-04-19T12:50:07.186Z', 'firstRegistration': '2020-05-18T13:52:00.102Z', 'firstRegistrationCompleted': '2020-05-18T15:21:11.762Z'}, 'onboardingUsp': None, 'appOpenedCount': 10, 'dailyTipConfig': {'tipHistory': {'2021-04-19': 'tips.tip33', '2021-04-28': 'tips.tip67', '2021-05-03': 'tips.tipContentExperiment1', '2021-05-04': 'tips.tip40', '2021-05-06': 'tips.tip24', '2021-05-10': 'tips.tip61', '2021-05-11': 'tips.tip63', '2021-05-12': 'tips.tip12', '2021-08-03': 'tips.tip42'}}, 'networkOnboarding': None, 'trackingOnboarding': None, 'stepCountOnboarding': None, 'dailyPlannerOnboarding': None, 'onboardingChallengeEvents': [], 'feedbackCTAReminderDate': None, 'feedbackSentOrSkippedDate': None, 'dontShowRecurringEventInfo': False, 'dontShowThoughtRecordsIntro': False, 'firstOnboardingExperimentOption': None, 'lastRegistrationValueByTrackerName': {}}}}}, 'user': {'username': 'test.test@test.nl', 'email': 'test.test@test.nl', 'isActive': True, 'dateJoined': '2020-05-13T18:49:12.025Z', 'isPublic': True, 'hashId': 'testtesttest', 'id': 12345}} # noqa
 
 
 @pytest.mark.integration
-def test_get_profile_from_server():
+def test_get_profile_from_server(client):
     """
     Test fetching of a (known) user from the Sensehealth server
     """
-    client = NicedayClient()
     existing_user_id = 38527
     profile = client.get_profile(existing_user_id)
     assert isinstance(profile, dict)
@@ -41,28 +47,343 @@ def test_get_profile(mock_call_api):
         assert isinstance(profile[k], str)
 
 
+def test_retry_policy():
+    """
+    Transient server errors are retried for GET and POST, 4xx responses are not
+    """
+    client = NicedayClient()
+    for prefix in ('http://', 'https://'):
+        retries = client._session.get_adapter(prefix).max_retries
+        assert retries.total == 5
+        assert set(retries.status_forcelist) == {500, 502, 503, 504}
+        assert set(retries.allowed_methods) == {'GET', 'POST'}
+        assert retries.raise_on_status is False
+        assert not retries.is_retry('GET', 401, has_retry_after=False)
+        assert retries.is_retry('POST', 503, has_retry_after=False)
+
+
+def test_tracker_status_copy_and_pickle():
+    status = TrackerStatus(trackerId=Tracker.SMOKING, isEnabled=True)
+    assert copy.copy(status) == status
+    assert copy.deepcopy(status) == status
+    assert pickle.loads(pickle.dumps(status)) == status
+
+
+def test_tracker_status_frozen():
+    status = TrackerStatus(trackerId=Tracker.SMOKING, isEnabled=True)
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        status.isEnabled = False
+
+
+def test_post_body_orjson():
+    """
+    With orjson available, request bodies are sent as pre-serialized JSON bytes
+    """
+    orjson = pytest.importorskip('orjson')
+    client = NicedayClient()
+    with mock.patch('niceday_client.niceday_client.orjson', orjson), \
+            mock.patch.object(client._session, 'post') as mock_post:
+        client.post_message(12345, 'Hello world')
+
+    kwargs = mock_post.call_args.kwargs
+    assert kwargs['data'] == b'{"recipient_id":12345,"text":"Hello world"}'
+    assert kwargs['headers'] == {'Content-Type': 'application/json'}
+    assert 'json' not in kwargs
+
+
+def test_post_body_without_orjson():
+    """
+    Without orjson, request bodies are serialized by requests
+    """
+    client = NicedayClient()
+    with mock.patch('niceday_client.niceday_client.orjson', None), \
+            mock.patch.object(client._session, 'post') as mock_post:
+        client.post_message(12345, 'Hello world')
+
+    kwargs = mock_post.call_args.kwargs
+    assert kwargs['json'] == {'recipient_id': 12345, 'text': 'Hello world'}
+    assert 'data' not in kwargs
+
+
+@mock.patch('niceday_client.NicedayClient._call_api')
+def test_get_profile_error_message(mock_call_api):
+    """
+    Error messages in the niceday-api response are raised as RuntimeError
+    """
+    mock_response = mock.MagicMock()
+    mock_response.json.return_value = {'message': 'Unauthorized error: invalid token',
+                                       'details': {'body': 'token expired'}}
+    mock_call_api.return_value = mock_response
+    client = NicedayClient()
+    with pytest.raises(RuntimeError, match="'Unauthorized error' response.*token expired"):
+        client.get_profile(12345)
+
+
+@mock.patch('niceday_client.NicedayClient._call_api')
+def test_get_profile_cached(mock_call_api):
+    """
+    Repeated get_profile() calls for the same user are served from the cache,
+    unless refresh is requested or the user's trackers are changed.
+    """
+    mock_response = mock.MagicMock()
+    mock_response.json.return_value = MOCK_PROFILE_RESPONSE
+    mock_response.headers = {}
+    mock_call_api.return_value = mock_response
+    client = NicedayClient()
+
+    first = client.get_profile(12345)
+    assert client.get_profile(12345) == first
+    assert mock_call_api.call_count == 1
+
+    client.get_profile(12345, refresh=True)
+    assert mock_call_api.call_count == 2
+
+    write_response = mock.MagicMock()
+    write_response.json.side_effect = ValueError
+    mock_call_api.return_value = write_response
+    client.set_user_tracker_statuses(12345, [])
+    mock_call_api.return_value = mock_response
+    client.get_profile(12345)
+    assert mock_call_api.call_count == 4
+
+
+@mock.patch('niceday_client.NicedayClient._call_api')
+def test_get_profile_cache_evicts_least_recently_used(mock_call_api):
+    """
+    The profile cache holds at most profile_cache_size users
+    """
+    mock_response = mock.MagicMock()
+    mock_response.json.return_value = MOCK_PROFILE_RESPONSE
+    mock_call_api.return_value = mock_response
+    client = NicedayClient(profile_cache_size=2)
+
+    client.get_profile(1)
+    client.get_profile(2)
+    client.get_profile(1)
+    client.get_profile(3)  # evicts user 2
+    assert mock_call_api.call_count == 3
+
+    client.get_profile(1)
+    assert mock_call_api.call_count == 3
+    client.get_profile(2)
+    assert mock_call_api.call_count == 4
+
+
+@mock.patch('niceday_client.NicedayClient._call_api')
+def test_get_profile_not_modified(mock_call_api):
+    """
+    Expired cache entries are revalidated with their ETag, a 304 response
+    serves the cached user data.
+    """
+    mock_response = mock.MagicMock()
+    mock_response.status_code = 200
+    mock_response.headers = {'ETag': '"abc"'}
+    mock_response.json.return_value = MOCK_PROFILE_RESPONSE
+    not_modified = mock.MagicMock()
+    not_modified.status_code = 304
+    mock_call_api.side_effect = [mock_response, not_modified]
+    client = NicedayClient(profile_ttl_seconds=0)
+
+    first = client.get_profile(12345)
+    assert client.get_profile(12345) == first
+    assert mock_call_api.call_args.kwargs['headers'] == {'If-None-Match': '"abc"'}
+    not_modified.json.assert_not_called()
+
+
+@mock.patch('niceday_client.NicedayClient._call_api')
+def test_set_user_tracker_statuses_caches_user_data(mock_call_api):
+    """
+    User data returned by a write is stored in the profile cache
+    """
+    mock_response = mock.MagicMock()
+    mock_response.json.return_value = MOCK_PROFILE_RESPONSE
+    mock_call_api.return_value = mock_response
+    client = NicedayClient()
+
+    client.set_user_tracker_statuses(12345, [TrackerStatus(trackerId=Tracker.SMOKING, isEnabled=True)])
+    profile = client.get_profile(12345)
+    assert profile['firstName'] == 'Test'
+    assert mock_call_api.call_count == 1
+
+
+def _mock_streamed_response(content: bytes):
+    mock_response = mock.MagicMock()
+    mock_response.raw = io.BytesIO(content)
+    return mock_response
+
+
+SMOKING_TRACKER_RANGE = (datetime.datetime(2022, 1, 1), datetime.datetime(2022, 1, 2))
+
+
+@mock.patch('niceday_client.NicedayClient._call_api')
+def test_get_smoking_tracker_streamed(mock_call_api):
+    """
+    Unit test for NicedayClient.get_smoking_tracker() with a mocked streamed response
+    """
+    mock_call_api.return_value = _mock_streamed_response(
+        b'[{"value": {"quantity": 1}}, {"value": {"quantity": 2.5}}]')
+    client = NicedayClient()
+    result = client.get_smoking_tracker(12345, *SMOKING_TRACKER_RANGE)
+
+    assert result == [{'value': {'quantity': 1}}, {'value': {'quantity': 2.5}}]
+    assert mock_call_api.call_args.kwargs['stream'] is True
+
+
+@mock.patch('niceday_client.NicedayClient._call_api')
+def test_get_smoking_tracker_error_message(mock_call_api):
+    """
+    Error messages in a streamed response are raised as RuntimeError
+    """
+    mock_call_api.return_value = _mock_streamed_response(
+        b'{"message": "Unauthorized error", "details": {"body": "token expired"}}')
+    client = NicedayClient()
+    with pytest.raises(RuntimeError, match="'Unauthorized error' response.*token expired"):
+        client.get_smoking_tracker(12345, *SMOKING_TRACKER_RANGE)
+
+
+@pytest.mark.parametrize('content', [b'null', b'"str"', b'42', b'{"entries": []}'])
+@mock.patch('niceday_client.NicedayClient._call_api')
+def test_get_smoking_tracker_not_a_list(mock_call_api, content):
+    """
+    A streamed response that is not a JSON list raises ValueError
+    """
+    mock_call_api.return_value = _mock_streamed_response(content)
+    client = NicedayClient()
+    with pytest.raises(ValueError, match='did not return a list'):
+        client.get_smoking_tracker(12345, *SMOKING_TRACKER_RANGE)
+
+
+def test_call_api_closes_failed_response():
+    """
+    Responses that fail raise_for_status() are closed before the error is raised
+    """
+    client = NicedayClient()
+    mock_response = mock.MagicMock()
+    mock_response.raise_for_status.side_effect = requests.HTTPError('500 Server Error')
+    with mock.patch.object(client._session, 'get', return_value=mock_response):
+        with pytest.raises(requests.HTTPError):
+            client._call_api('GET', 'http://localhost:8080/usertrackers/smoking/12345', stream=True)
+    mock_response.close.assert_called_once()
+
+
+@mock.patch('niceday_client.NicedayClient._call_api')
+def test_get_smoking_tracker_not_json(mock_call_api):
+    """
+    A streamed response that is not JSON raises ValueError
+    """
+    mock_call_api.return_value = _mock_streamed_response(b'<html>Bad gateway</html>')
+    client = NicedayClient()
+    with pytest.raises(ValueError, match='did not return JSON'):
+        client.get_smoking_tracker(12345, *SMOKING_TRACKER_RANGE)
+
+
+@mock.patch('niceday_client.NicedayClient._call_api')
+def test_set_user_tracker_statuses_invalidates_user_data(mock_call_api):
+    """
+    User data cached while a write is in flight is dropped once the write
+    returns no user data
+    """
+    mock_response = mock.MagicMock()
+    mock_response.json.return_value = MOCK_PROFILE_RESPONSE
+    mock_response.headers = {}
+    client = NicedayClient()
+
+    def write_during_read(method, url, **kwargs):
+        # a concurrent get_profile caches the pre-write data
+        mock_call_api.side_effect = None
+        mock_call_api.return_value = mock_response
+        client.get_profile(12345)
+        write_response = mock.MagicMock()
+        write_response.json.side_effect = ValueError
+        return write_response
+
+    mock_call_api.side_effect = write_during_read
+    client.set_user_tracker_statuses(12345, [])
+    client.get_profile(12345)
+    assert mock_call_api.call_count == 3
+
+
+@mock.patch('niceday_client.NicedayClient._call_api')
+def test_set_user_tracker_statuses_body(mock_call_api):
+    """
+    Tracker statuses are sent as plain trackerId/isEnabled dicts
+    """
+    client = NicedayClient()
+    client.set_user_tracker_statuses(12345, [TrackerStatus(Tracker.SMOKING, True)])
+
+    body = mock_call_api.call_args.kwargs['body']
+    assert body == {"userId": 12345, "trackerStatuses": [{"trackerId": 1, "isEnabled": True}]}
+    assert type(body["trackerStatuses"][0]["trackerId"]) is int
+
+
+REMINDER_RULE = rrule(DAILY, dtstart=datetime.datetime(2022, 5, 12, 0, 0),
+                      until=datetime.datetime(2022, 5, 13, 0, 0))
+
+EXPECTED_REMINDER_BODY = {
+    "userId": "12345",
+    "recurringSchedule": {
+        "title": "This is a tracker",
+        "schedule_type": "tracker_smoking",
+        "recurring_expression": {
+            "margin": {"before": 0, "after": 60},
+            "reminder_enabled": True,
+            "reminder_margin": [{"before": 0, "after": 60}],
+            "rrule": "DTSTART:20220512T000000\nRRULE:FREQ=DAILY;UNTIL=20220513T000000"
+        }
+    }
+}
+
+
+@mock.patch('niceday_client.NicedayClient._call_api')
+def test_set_tracker_reminder_body(mock_call_api):
+    """
+    Unit test for the request body sent by NicedayClient.set_tracker_reminder()
+    """
+    client = NicedayClient()
+    client.set_tracker_reminder(12345, TrackerName.SMOKING, "This is a tracker", REMINDER_RULE)
+    # the margins are shared between calls, a second call must send the same body
+    client.set_tracker_reminder(12345, TrackerName.SMOKING, "This is a tracker", REMINDER_RULE)
+
+    assert mock_call_api.call_args.kwargs['body'] == EXPECTED_REMINDER_BODY
+
+
+@mock.patch('niceday_client.NicedayClient._call_api')
+def test_get_profiles_batch(mock_call_api):
+    """
+    Unit test for NicedayClient.get_profiles_batch() method with mocked server
+    """
+    mock_response = mock.MagicMock()
+    mock_response.json.return_value = MOCK_PROFILE_RESPONSE
+    mock_response.headers = {}
+    mock_call_api.return_value = mock_response
+    client = NicedayClient()
+    profiles = client.get_profiles_batch([1, 2, 3], max_workers=2)
+
+    assert list(profiles) == [1, 2, 3]
+    assert mock_call_api.call_count == 3
+    for profile in profiles.values():
+        assert profile == client.get_profile(12345)
+
+
 @pytest.mark.integration
-def test_post_message():
+def test_post_message(client):
     """
     Test posting a message to the Niceday server
     """
-    client = NicedayClient()
     existing_user_id = 38527  # Please change this to your own test user id if used frequently
     client.post_message(existing_user_id, 'Hello world')
 
 
 @pytest.mark.integration
-def test_set_user_tracker_statuses():
-    client = NicedayClient()
+def test_set_user_tracker_statuses(client):
     existing_user_id = 38527  # Please change this to your own test user id if used frequently
     client.set_user_tracker_statuses(
         user_id=existing_user_id,
-        tracker_statuses=[TrackerStatus(trackerId=Tracker.SMOKING.value[0], isEnabled=True)])
+        tracker_statuses=[TrackerStatus(trackerId=Tracker.SMOKING, isEnabled=True)])
 
 
 @pytest.mark.integration
-def test_get_smoking_tracker():
-    client = NicedayClient()
+def test_get_smoking_tracker(client):
     existing_user_id = 38527  # Please change this to your own test user id if used frequently
     result = client.get_smoking_tracker(
         user_id=existing_user_id,